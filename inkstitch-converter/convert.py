@@ -4,19 +4,25 @@ Professional SVG to DST converter using pyembroidery
 Optimal settings for different garment types (hat, shirt, jacket)
 """
 
+import io
+import math
 import os
 import sys
 import tempfile
 import json
-import xml.etree.ElementTree as ET
 import re
 from pathlib import Path
 
-try:
-    import pyembroidery
-except ImportError:
-    print("Error: pyembroidery not installed")
-    sys.exit(1)
+SVG_NS = 'http://www.w3.org/2000/svg'
+SVG_SHAPE_TAGS = (f'{{{SVG_NS}}}path', f'{{{SVG_NS}}}rect', f'{{{SVG_NS}}}circle')
+
+# Numbers inside SVG path data
+_NUMBER_RE = re.compile(r'-?\d*\.?\d+')
+
+# Unit circle used to approximate <circle> elements with a 16-sided polygon
+_CIRCLE_COS_SIN = tuple(
+    (math.cos(2 * math.pi * i / 16), math.sin(2 * math.pi * i / 16)) for i in range(16)
+)
 
 # Optimal embroidery settings for each garment type
 GARMENT_SETTINGS = {
@@ -45,89 +51,86 @@ GARMENT_SETTINGS = {
 
 def extract_svg_paths(svg_content):
     """Extract path coordinates from SVG content"""
+    # Imported here (outside the try) so a missing lxml fails the conversion loudly
+    from lxml import etree as ET
+    
     try:
-        # Parse SVG
-        root = ET.fromstring(svg_content)
+        # Stream the SVG (lxml wants bytes when the document has an XML declaration)
+        if isinstance(svg_content, str):
+            svg_content = svg_content.encode('utf-8')
         
-        # Find namespace
-        ns = {'svg': 'http://www.w3.org/2000/svg'}
-        if root.tag.startswith('{'):
-            ns_url = root.tag.split('}')[0][1:]
-            ns['svg'] = ns_url
+        path_coords = []
+        rect_coords = []
+        circle_coords = []
         
-        paths = []
-        
-        # Extract path elements
-        for path_elem in root.findall('.//svg:path', ns):
-            d = path_elem.get('d', '')
-            if d:
-                coords = parse_path_data(d)
-                if coords:
-                    paths.extend(coords)
-        
-        # Extract rectangles
-        for rect in root.findall('.//svg:rect', ns):
-            x = float(rect.get('x', 0))
-            y = float(rect.get('y', 0))
-            width = float(rect.get('width', 0))
-            height = float(rect.get('height', 0))
+        for _, elem in ET.iterparse(io.BytesIO(svg_content), events=('end',), tag=SVG_SHAPE_TAGS):
+            tag = elem.tag.rsplit('}', 1)[-1]
             
-            if width > 0 and height > 0:
-                # Convert rectangle to path coordinates
-                rect_path = [
-                    (x, y),
-                    (x + width, y),
-                    (x + width, y + height),
-                    (x, y + height),
-                    (x, y)
-                ]
-                paths.append(rect_path)
-        
-        # Extract circles
-        for circle in root.findall('.//svg:circle', ns):
-            cx = float(circle.get('cx', 0))
-            cy = float(circle.get('cy', 0))
-            r = float(circle.get('r', 0))
+            if tag == 'path':
+                d = elem.get('d', '')
+                if d:
+                    coords = parse_path_data(d)
+                    if coords:
+                        path_coords.extend(coords)
             
-            if r > 0:
-                # Approximate circle with polygon
-                import math
-                circle_path = []
-                for i in range(16):  # 16-sided polygon
-                    angle = 2 * math.pi * i / 16
-                    x = cx + r * math.cos(angle)
-                    y = cy + r * math.sin(angle)
-                    circle_path.append((x, y))
-                circle_path.append(circle_path[0])  # Close the path
-                paths.append(circle_path)
+            elif tag == 'rect':
+                x = float(elem.get('x', 0))
+                y = float(elem.get('y', 0))
+                width = float(elem.get('width', 0))
+                height = float(elem.get('height', 0))
+                
+                if width > 0 and height > 0:
+                    # Convert rectangle to path coordinates
+                    rect_path = [
+                        (x, y),
+                        (x + width, y),
+                        (x + width, y + height),
+                        (x, y + height),
+                        (x, y)
+                    ]
+                    rect_coords.append(rect_path)
+            
+            elif tag == 'circle':
+                cx = float(elem.get('cx', 0))
+                cy = float(elem.get('cy', 0))
+                r = float(elem.get('r', 0))
+                
+                if r > 0:
+                    # Approximate circle with polygon
+                    circle_path = [(cx + r * c, cy + r * s) for c, s in _CIRCLE_COS_SIN]
+                    circle_path.append(circle_path[0])  # Close the path
+                    circle_coords.append(circle_path)
+            
+            # Free the element and any already-processed siblings
+            elem.clear()
+            while elem.getprevious() is not None:
+                del elem.getparent()[0]
         
-        return paths
+        # Keep the paths, rects, circles stitch order
+        return path_coords + rect_coords + circle_coords
         
     except Exception as e:
         print(f"Error parsing SVG: {e}")
         return []
 
 def parse_path_data(path_data):
-    """Parse SVG path data into coordinate lists"""
+    """Parse SVG path data into (N, 2) coordinate arrays"""
+    # Imported here (outside the try) so a missing numpy fails the conversion loudly
+    import numpy as np
+    
     try:
         # Simple path parser for M, L, H, V commands
         coords = []
         current_path = []
         
         # Extract numbers from path
-        numbers = re.findall(r'-?\d*\.?\d+', path_data)
+        numbers = _NUMBER_RE.findall(path_data)
         if len(numbers) < 4:
             return []
         
-        # Convert to coordinate pairs
-        points = []
-        for i in range(0, len(numbers) - 1, 2):
-            try:
-                x = float(numbers[i])
-                y = float(numbers[i + 1])
-                points.append((x, y))
-            except (ValueError, IndexError):
-                continue
+        # Convert to an (N, 2) array of coordinate pairs, dropping a trailing odd number
+        values = np.array(numbers, dtype=np.float64)
+        points = values[:len(values) // 2 * 2].reshape(-1, 2)
         
         if len(points) >= 2:
             coords.append(points)
@@ -141,6 +144,9 @@ def parse_path_data(path_data):
 def convert_svg_to_dst(svg_content, output_path, garment_type='hat'):
     """Convert SVG to DST using pyembroidery"""
     try:
+        import numpy as np
+        import pyembroidery
+        
         settings = GARMENT_SETTINGS.get(garment_type, GARMENT_SETTINGS['hat'])
         
         # Extract paths from SVG
@@ -150,18 +156,14 @@ def convert_svg_to_dst(svg_content, output_path, garment_type='hat'):
             # Create a simple test pattern if no paths found
             paths = [[(0, 0), (100, 0), (100, 100), (0, 100), (0, 0)]]
         
-        # Calculate bounds
-        all_points = []
-        for path in paths:
-            all_points.extend(path)
+        # Convert each path to an (N, 2) array once; reused for bounds and stitching
+        paths = [np.asarray(path, dtype=np.float64).reshape(-1, 2) for path in paths]
         
-        if not all_points:
-            return False, "No valid paths found in SVG"
+        # Calculate bounds from one concatenated array with per-axis min/max reductions
+        all_points = np.concatenate(paths)
         
-        xs = [p[0] for p in all_points]
-        ys = [p[1] for p in all_points]
-        min_x, max_x = min(xs), max(xs)
-        min_y, max_y = min(ys), max(ys)
+        min_x, min_y = all_points.min(axis=0).tolist()
+        max_x, max_y = all_points.max(axis=0).tolist()
         
         width = max_x - min_x
         height = max_y - min_y
@@ -177,28 +179,24 @@ def convert_svg_to_dst(svg_content, output_path, garment_type='hat'):
         # Create embroidery pattern
         pattern = pyembroidery.EmbPattern()
         
+        origin = np.array([min_x, min_y], dtype=np.float64)
+        
         # Convert paths to stitches
-        for path_index, path in enumerate(paths):
+        for path in paths:
             if len(path) < 2:
                 continue
-                
-            # Move to start of path
-            start_x = (path[0][0] - min_x) * scale
-            start_y = (path[0][1] - min_y) * scale
             
-            if path_index == 0:
-                pattern.move_abs(start_x, start_y)
-            else:
-                pattern.move_abs(start_x, start_y)
+            # Translate and scale the whole path in one array operation
+            pts = (path - origin) * scale
             
-            # Stitch along path
-            for point in path[1:]:
-                x = (point[0] - min_x) * scale
-                y = (point[1] - min_y) * scale
-                pattern.stitch_abs(x, y)
+            # Jump to the start of the path, then stitch along it
+            stitches = [[x, y, pyembroidery.STITCH] for x, y in pts.tolist()]
+            stitches[0][2] = pyembroidery.JUMP
+            pattern.stitches.extend(stitches)
         
-        # End the pattern
-        pattern.end()
+        # End the pattern at the last stitch position
+        end_x, end_y = pattern.stitches[-1][:2] if pattern.stitches else (0, 0)
+        pattern.add_stitch_absolute(pyembroidery.END, end_x, end_y)
         
         # Save as DST
         pyembroidery.write_dst(pattern, output_path)
@@ -208,6 +206,25 @@ def convert_svg_to_dst(svg_content, output_path, garment_type='hat'):
     except Exception as e:
         return False, f"Conversion error: {str(e)}"
 
+def emit_json(result, stream):
+    """Write a result object as one line of JSON to stdout/stderr"""
+    try:
+        import orjson
+    except ImportError:
+        orjson = None
+    
+    # Text-only streams (StringIO, redirected stdout) have no binary buffer
+    buffer = getattr(stream, 'buffer', None)
+    if orjson is None or buffer is None:
+        # Compact separators match orjson, so the output bytes don't depend on which is installed
+        print(json.dumps(result, separators=(',', ':')), file=stream)
+        return
+    
+    # Flush pending text first so the raw bytes land after it
+    stream.flush()
+    buffer.write(orjson.dumps(result) + b'\n')
+    buffer.flush()
+
 def main():
     """Command line interface for conversion"""
     if len(sys.argv) != 4:
@@ -237,7 +254,10 @@ def main():
     
     if success:
         # Get file size for reporting
-        file_size = os.path.getsize(output_dst) if os.path.exists(output_dst) else 0
+        try:
+            file_size = os.stat(output_dst).st_size
+        except OSError:
+            file_size = 0
         settings = GARMENT_SETTINGS[garment_type]
         result = {
             'success': True,
@@ -247,14 +267,14 @@ def main():
             'file_size': file_size,
             'message': message
         }
-        print(json.dumps(result))
+        emit_json(result, sys.stdout)
     else:
         result = {
             'success': False,
             'error': message,
             'garment_type': garment_type
         }
-        print(json.dumps(result), file=sys.stderr)
+        emit_json(result, sys.stderr)
         sys.exit(1)
 
 if __name__ == '__main__':
@@ -3,19 +3,62 @@
 Flask API server for SVG to DST conversion using Ink/Stitch
 """
 
+import atexit
+import fcntl
+import io
 import os
+import shutil
+import signal
 import tempfile
+import threading
+import time
 import uuid
 from flask import Flask, request, jsonify, send_file
 import subprocess
-import json
 from pathlib import Path
 
+# Imported once per worker; pyembroidery/lxml/numpy load on first use and stay cached
+import convert as _converter
+
 app = Flask(__name__)
 
 # Configure upload limits
 app.config['MAX_CONTENT_LENGTH'] = 5 * 1024 * 1024  # 5MB limit
 
+# Per-worker scratch directory reused by every conversion, removed when the worker exits
+SCRATCH_DIR = tempfile.mkdtemp(prefix='inkstitch_')
+atexit.register(shutil.rmtree, SCRATCH_DIR, ignore_errors=True)
+
+# Upper bound on a single in-process conversion, in seconds
+CONVERSION_TIMEOUT = 60
+
+class ConversionTimeout(BaseException):
+    """Raised by SIGALRM; a BaseException so the converter's catch-all handlers can't swallow it"""
+
+def run_conversion(svg_content, dst_path, garment_type):
+    """
+    Run the converter in-process, bounded by CONVERSION_TIMEOUT
+    The alarm needs the main thread (gunicorn sync workers); the threaded
+    development server runs the conversion unbounded instead
+    """
+    if threading.current_thread() is not threading.main_thread():
+        return _converter.convert_svg_to_dst(svg_content, dst_path, garment_type)
+    
+    def on_timeout(signum, frame):
+        raise ConversionTimeout()
+    
+    previous_handler = signal.signal(signal.SIGALRM, on_timeout)
+    try:
+        signal.setitimer(signal.ITIMER_REAL, CONVERSION_TIMEOUT)
+        try:
+            return _converter.convert_svg_to_dst(svg_content, dst_path, garment_type)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except ConversionTimeout:
+        return False, f'Conversion timed out after {CONVERSION_TIMEOUT}s'
+    finally:
+        signal.signal(signal.SIGALRM, previous_handler)
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -55,56 +98,50 @@ def convert_svg_to_dst():
         if garment_type not in ['hat', 'shirt', 'jacket']:
             return jsonify({'error': 'Invalid garment type'}), 400
         
-        # Validate SVG file
-        if not svg_file.filename.lower().endswith('.svg'):
+        # Validate SVG file (only the 4-char suffix is case-folded)
+        filename = svg_file.filename
+        if filename[-4:].lower() != '.svg':
             return jsonify({'error': 'File must be an SVG'}), 400
+        stem = filename[:-4]
         
-        # Create temporary directory for this conversion
-        temp_dir = tempfile.mkdtemp()
         conversion_id = str(uuid.uuid4())
         
+        # Output DST path; recreate the scratch dir if a tmp reaper removed it
+        os.makedirs(SCRATCH_DIR, exist_ok=True)
+        dst_path = os.path.join(SCRATCH_DIR, f'{conversion_id}.dst')
+        
         try:
-            # Save uploaded SVG
-            svg_path = os.path.join(temp_dir, f'{conversion_id}.svg')
-            svg_file.save(svg_path)
-            
-            # Output DST path
-            dst_path = os.path.join(temp_dir, f'{conversion_id}.dst')
+            # Read uploaded SVG
+            svg_content = svg_file.read()
             
-            # Call conversion script
-            cmd = ['python3', '/opt/convert.py', svg_path, dst_path, garment_type]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            # Run conversion in-process
+            success, message = run_conversion(svg_content, dst_path, garment_type)
             
-            if result.returncode == 0:
-                # Parse conversion result
+            if success:
                 try:
-                    conversion_result = json.loads(result.stdout)
-                    
-                    if os.path.exists(dst_path):
-                        # Return the DST file
-                        return send_file(
-                            dst_path,
-                            as_attachment=True,
-                            download_name=f'{svg_file.filename.rsplit(".", 1)[0]}.dst',
-                            mimetype='application/octet-stream'
-                        )
-                    else:
-                        return jsonify({'error': 'DST file was not generated'}), 500
-                        
-                except json.JSONDecodeError:
-                    return jsonify({'error': 'Invalid conversion result'}), 500
+                    # Return the DST file from memory; no ETag or conditional GET for one-shot output
+                    with open(dst_path, 'rb') as f:
+                        dst_buffer = io.BytesIO(f.read())
+                    return send_file(
+                        dst_buffer,
+                        as_attachment=True,
+                        download_name=f'{stem}.dst',
+                        mimetype='application/octet-stream',
+                        conditional=False,
+                        etag=False,
+                        max_age=0
+                    )
+                except FileNotFoundError:
+                    return jsonify({'error': 'DST file was not generated'}), 500
             else:
-                # Parse error from conversion script
-                try:
-                    error_result = json.loads(result.stderr)
-                    return jsonify({'error': error_result.get('error', 'Conversion failed')}), 500
-                except json.JSONDecodeError:
-                    return jsonify({'error': f'Conversion failed: {result.stderr}'}), 500
+                return jsonify({'error': message}), 500
                 
         finally:
-            # Clean up temporary files
-            import shutil
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            # Clean up this conversion's output
+            try:
+                os.remove(dst_path)
+            except FileNotFoundError:
+                pass
             
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
@@ -123,64 +160,110 @@ def test_conversion():
         
         svg_content = data['svg_content']
         garment_type = data.get('garment_type', 'hat')
+        
+        if not isinstance(svg_content, str):
+            return jsonify({'error': 'svg_content must be a string'}), 400
         filename = data.get('filename', 'design.svg')
+        encoding = data.get('encoding')
         
         if garment_type not in ['hat', 'shirt', 'jacket']:
             return jsonify({'error': 'Invalid garment type'}), 400
         
-        # Create temporary directory
-        temp_dir = tempfile.mkdtemp()
         conversion_id = str(uuid.uuid4())
         
+        # Output DST path; recreate the scratch dir if a tmp reaper removed it
+        os.makedirs(SCRATCH_DIR, exist_ok=True)
+        dst_path = os.path.join(SCRATCH_DIR, f'{conversion_id}.dst')
+        
         try:
-            # Save SVG content
-            svg_path = os.path.join(temp_dir, f'{conversion_id}.svg')
-            with open(svg_path, 'w') as f:
-                f.write(svg_content)
-            
-            # Output DST path
-            dst_path = os.path.join(temp_dir, f'{conversion_id}.dst')
-            
-            # Call conversion script
-            cmd = ['python3', '/opt/convert.py', svg_path, dst_path, garment_type]
-            result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
+            # Run conversion in-process
+            success, message = run_conversion(svg_content, dst_path, garment_type)
             
-            if result.returncode == 0:
-                # Read DST file and return as base64
-                if os.path.exists(dst_path):
+            if success:
+                try:
+                    # Return raw DST bytes unless base64 was explicitly requested
+                    if encoding != 'base64':
+                        with open(dst_path, 'rb') as f:
+                            dst_buffer = io.BytesIO(f.read())
+                        return send_file(
+                            dst_buffer,
+                            as_attachment=True,
+                            download_name=filename.replace('.svg', '.dst'),
+                            mimetype='application/octet-stream',
+                            conditional=False,
+                            etag=False,
+                            max_age=0
+                        )
+                    
+                    # Encode straight from a read-only mapping of the DST file
                     import base64
+                    import mmap
                     with open(dst_path, 'rb') as f:
-                        dst_content = f.read()
-                    
-                    dst_base64 = base64.b64encode(dst_content).decode('utf-8')
+                        with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as dst_map:
+                            dst_base64 = base64.b64encode(dst_map).decode('ascii')
+                            file_size = len(dst_map)
                     
                     return jsonify({
                         'success': True,
                         'dst_content': dst_base64,
                         'garment_type': garment_type,
-                        'file_size': len(dst_content),
+                        'file_size': file_size,
                         'filename': filename.replace('.svg', '.dst')
                     })
-                else:
+                except FileNotFoundError:
                     return jsonify({'error': 'DST file was not generated'}), 500
             else:
-                return jsonify({'error': f'Conversion failed: {result.stderr}'}), 500
+                return jsonify({'error': f'Conversion failed: {message}'}), 500
                 
         finally:
-            # Clean up
-            import shutil
-            shutil.rmtree(temp_dir, ignore_errors=True)
+            # Clean up this conversion's output
+            try:
+                os.remove(dst_path)
+            except FileNotFoundError:
+                pass
             
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
+def display_running():
+    """Check whether the X server recorded in display :99's lock file is alive"""
+    try:
+        with open('/tmp/.X99-lock') as f:
+            pid = int(f.read().strip())
+    except (OSError, ValueError):
+        # No lock, or an unreadable/garbled one
+        return False
+    
+    try:
+        os.kill(pid, 0)
+    except PermissionError:
+        # Process exists but belongs to another user
+        return True
+    except OSError:
+        # Stale lock left by a dead server
+        return False
+    return True
+
 # Initialize virtual display when running directly
 def init_display():
     """Initialize virtual display for headless operation"""
     try:
-        # Start virtual display for headless operation
-        subprocess.Popen(['Xvfb', ':99', '-screen', '0', '1024x768x24'], 
-                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # Serialize the check-and-spawn across gunicorn workers
+        with open('/tmp/.inkstitch-xvfb-start', 'w') as guard:
+            fcntl.flock(guard, fcntl.LOCK_EX)
+            
+            if display_running():
+                return
+            
+            # Start virtual display for headless operation
+            subprocess.Popen(['Xvfb', ':99', '-screen', '0', '1024x768x24'], 
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            
+            # Hold the guard until Xvfb has written its lock so the next worker sees it
+            for _ in range(50):
+                if display_running():
+                    break
+                time.sleep(0.1)
     except Exception as e:
         print(f"Warning: Could not start virtual display: {e}")
 